@@ -1,12 +1,27 @@
+import functools
+import re
+
+# Deletes every ASCII character other than space, tab and newline
+SANITIZE_TABLE = str.maketrans('', '', ''.join(chr(c) for c in range(128) if chr(c) not in " \t\n"))
+
+NON_WHITESPACE_RE = re.compile('[^ \t\n]+')
+
 def sanitize(instructions):
-    return "".join(instruction for instruction in instructions if instruction in " \t\n")
+    if instructions.isascii():
+        return instructions.translate(SANITIZE_TABLE)
+    return NON_WHITESPACE_RE.sub('', instructions)
 
 class Instruction:
-    def perform(self, vm):
-        self._perform(vm)
-        vm.instruction_index += 1
+    is_label = False
+    is_branch = False
 
 class Nullary(Instruction):
+    argument = None
+
+    def __init__(self):
+        # Instances are shared between tokens, so their lowered form can be shared too
+        self.lowered = (self.opcode, None)
+
     def __str__(self):
         return f'{type(self).__name__}'
 
@@ -17,224 +32,473 @@ class Unary(Instruction):
     def __init__(self, argument):
         self.argument = argument
 
+    @property
+    def lowered(self):
+        return (self.opcode, self.argument)
+
     def __str__(self):
         return f'{type(self).__name__}({repr(self.argument)})'
 
     def __repr__(self):
         return str(self)
 
+class Push(Unary):
+    opcode = 0
+
 class Duplicate(Nullary):
-    def _perform(self, vm):
-        vm.stack.append(vm.stack[-1])
+    opcode = 1
+
+class Copy(Unary):
+    opcode = 2
 
 class Swap(Nullary):
-    def _perform(self, vm):
-        a = vm.stack.pop()
-        b = vm.stack.pop()
-        vm.stack.append(a)
-        vm.stack.append(b)
+    opcode = 3
 
 class Discard(Nullary):
-    def _perform(self, vm):
-        vm.stack.pop()
-
-class BinArith(Nullary):
-    def _perform(self, vm):
-        a = vm.stack.pop()
-        b = vm.stack.pop()
-        vm.stack.append(self._combine(a, b))
-
-class Add(BinArith):
-    def _combine(self, a, b):
-        return b + a
-
-class Subtract(BinArith):
-    def _combine(self, a, b):
-        return b - a
-
-class Multiply(BinArith):
-    def _combine(self, a, b):
-        return b * a
-
-class Division(BinArith):
-    def _combine(self, a, b):
-        if a == 0:
-            raise RuntimeError()
-        return b // a
-
-class Modulo(BinArith):
-    def _combine(self, a, b):
-        if a == 0:
-            raise RuntimeError()
-        return b % a
+    opcode = 4
+
+class Slide(Unary):
+    opcode = 5
+
+class Add(Nullary):
+    opcode = 6
+
+class Subtract(Nullary):
+    opcode = 7
+
+class Multiply(Nullary):
+    opcode = 8
+
+class Division(Nullary):
+    opcode = 9
+
+class Modulo(Nullary):
+    opcode = 10
 
 class Store(Nullary):
-    def _perform(self, vm):
-        a = vm.stack.pop()
-        b = vm.stack.pop()
-        vm.heap[b] = a
+    opcode = 11
 
 class Retrieve(Nullary):
-    def _perform(self, vm):
-        a = vm.stack.pop()
-        vm.stack.append(vm.heap[a])
+    opcode = 12
 
-class ReadChar(Nullary):
-    def _perform(self, vm):
-        char = vm.input[vm.input_index]
-        vm.input_index += 1
-        address = vm.stack.pop()
-        vm.heap[address] = ord(char)
+class Label(Unary):
+    is_label = True
 
-class ReadNumber(Nullary):
-    def _perform(self, vm):
-        string = ''
-        while (char := vm.input[vm.input_index]) != "\n":
-            string += char
-            vm.input_index += 1
-        vm.input_index += 1
-        address = vm.stack.pop()
-        vm.heap[address] = int(string)
+class Branch(Unary):
+    is_branch = True
 
-class WriteChar(Nullary):
-    def _perform(self, vm):
-        vm.output += chr(vm.stack.pop())
+class Call(Branch):
+    opcode = 13
 
-class WriteNumber(Nullary):
-    def _perform(self, vm):
-        vm.output += str(vm.stack.pop())
+class Jump(Branch):
+    opcode = 14
 
-class Return(Nullary):
-    def perform(self, vm):
-        vm.instruction_index = vm.call_stack.pop()
+class JumpIfZero(Branch):
+    opcode = 15
 
-class Exit(Nullary):
-    def perform(self, vm):
-        vm.stop()
+class JumpIfNegative(Branch):
+    opcode = 16
 
-class Push(Unary):
-    def _perform(self, vm):
-        vm.stack.append(self.argument)
+class Return(Nullary):
+    opcode = 17
 
-class Copy(Unary):
-    def _perform(self, vm):
-        if self.argument < 0:
-            raise RuntimeError()
-        vm.stack.append(vm.stack[-self.argument-1])
+class Exit(Nullary):
+    opcode = 18
 
-class Slide(Unary):
-    def _perform(self, vm):
-        a = vm.stack.pop()
-        if self.argument < 0:
-            n = len(vm.stack)
-        else:
-            n = min(len(vm.stack), self.argument)
-        vm.stack = vm.stack[:-n]
-        vm.stack.append(a)
+class WriteChar(Nullary):
+    opcode = 19
 
-class Label(Unary): pass
+class WriteNumber(Nullary):
+    opcode = 20
 
-class Call(Unary):
-    def perform(self, vm):
-        vm.call_stack.append(vm.instruction_index + 1)
-        vm.instruction_index = vm.label_table[self.argument]
+class ReadChar(Nullary):
+    opcode = 21
 
-class Jump(Unary):
-    def perform(self, vm):
-        vm.instruction_index = vm.label_table[self.argument]
+class ReadNumber(Nullary):
+    opcode = 22
+
+def handle_push(vm, ip, argument):
+    vm.stack.append(argument)
+    return ip + 1
+
+def handle_duplicate(vm, ip, argument):
+    vm.stack.append(vm.stack[-1])
+    return ip + 1
+
+def handle_copy(vm, ip, argument):
+    if argument < 0:
+        raise RuntimeError()
+    vm.stack.append(vm.stack[-argument-1])
+    return ip + 1
+
+def handle_swap(vm, ip, argument):
+    a = vm.stack.pop()
+    b = vm.stack.pop()
+    vm.stack.append(a)
+    vm.stack.append(b)
+    return ip + 1
+
+def handle_discard(vm, ip, argument):
+    vm.stack.pop()
+    return ip + 1
+
+def handle_slide(vm, ip, argument):
+    stack = vm.stack
+    a = stack.pop()
+    if argument < 0:
+        n = len(stack)
+    else:
+        n = min(len(stack), argument)
+    del stack[-n:]
+    stack.append(a)
+    return ip + 1
+
+def handle_add(vm, ip, argument):
+    stack = vm.stack
+    a = stack.pop()
+    stack.append(stack.pop() + a)
+    return ip + 1
+
+def handle_subtract(vm, ip, argument):
+    stack = vm.stack
+    a = stack.pop()
+    stack.append(stack.pop() - a)
+    return ip + 1
+
+def handle_multiply(vm, ip, argument):
+    stack = vm.stack
+    a = stack.pop()
+    stack.append(stack.pop() * a)
+    return ip + 1
+
+def handle_division(vm, ip, argument):
+    stack = vm.stack
+    a = stack.pop()
+    b = stack.pop()
+    if a == 0:
+        raise RuntimeError()
+    stack.append(b // a)
+    return ip + 1
+
+def handle_modulo(vm, ip, argument):
+    stack = vm.stack
+    a = stack.pop()
+    b = stack.pop()
+    if a == 0:
+        raise RuntimeError()
+    stack.append(b % a)
+    return ip + 1
+
+def handle_store(vm, ip, argument):
+    a = vm.stack.pop()
+    b = vm.stack.pop()
+    vm.heap[b] = a
+    return ip + 1
+
+def handle_retrieve(vm, ip, argument):
+    a = vm.stack.pop()
+    vm.stack.append(vm.heap[a])
+    return ip + 1
+
+def handle_call(vm, ip, argument):
+    vm.call_stack.append(ip + 1)
+    return argument
+
+def handle_jump(vm, ip, argument):
+    return argument
+
+def handle_jump_if_zero(vm, ip, argument):
+    if vm.stack.pop() == 0:
+        return argument
+    return ip + 1
+
+def handle_jump_if_negative(vm, ip, argument):
+    if vm.stack.pop() < 0:
+        return argument
+    return ip + 1
+
+def handle_return(vm, ip, argument):
+    return vm.call_stack.pop()
+
+def handle_exit(vm, ip, argument):
+    vm.stop()
+    return ip
+
+def handle_write_char(vm, ip, argument):
+    vm.output_parts.append(chr(vm.stack.pop()))
+    return ip + 1
+
+def handle_write_number(vm, ip, argument):
+    vm.output_parts.append(str(vm.stack.pop()))
+    return ip + 1
+
+def handle_read_char(vm, ip, argument):
+    char = vm.input[vm.input_index]
+    vm.input_index += 1
+    address = vm.stack.pop()
+    vm.heap[address] = ord(char)
+    return ip + 1
+
+def handle_read_number(vm, ip, argument):
+    end = vm.input.index('\n', vm.input_index)
+    value = int(vm.input[vm.input_index:end])
+    vm.input_index = end + 1
+    address = vm.stack.pop()
+    vm.heap[address] = value
+    return ip + 1
+
+# Indexed by opcode
+HANDLERS = [
+    handle_push,
+    handle_duplicate,
+    handle_copy,
+    handle_swap,
+    handle_discard,
+    handle_slide,
+    handle_add,
+    handle_subtract,
+    handle_multiply,
+    handle_division,
+    handle_modulo,
+    handle_store,
+    handle_retrieve,
+    handle_call,
+    handle_jump,
+    handle_jump_if_zero,
+    handle_jump_if_negative,
+    handle_return,
+    handle_exit,
+    handle_write_char,
+    handle_write_number,
+    handle_read_char,
+    handle_read_number,
+]
 
-class JumpIfZero(Unary):
-    def perform(self, vm):
-        if vm.stack.pop() == 0:
-            vm.instruction_index = vm.label_table[self.argument]
+# Source templates used to inline instructions into compiled blocks, indexed by opcode.
+# Instructions without a template are compiled into a call to their handler.
+BLOCK_TEMPLATES = {
+    Push.opcode: 'stack.append({argument})',
+    Duplicate.opcode: 'stack.append(stack[-1])',
+    Swap.opcode: 'a = stack.pop()\nb = stack.pop()\nstack.append(a)\nstack.append(b)',
+    Discard.opcode: 'stack.pop()',
+    Add.opcode: 'a = stack.pop()\nstack.append(stack.pop() + a)',
+    Subtract.opcode: 'a = stack.pop()\nstack.append(stack.pop() - a)',
+    Multiply.opcode: 'a = stack.pop()\nstack.append(stack.pop() * a)',
+    Division.opcode: 'a = stack.pop()\nb = stack.pop()\nif a == 0: raise RuntimeError()\nstack.append(b // a)',
+    Modulo.opcode: 'a = stack.pop()\nb = stack.pop()\nif a == 0: raise RuntimeError()\nstack.append(b % a)',
+    Store.opcode: 'a = stack.pop()\nb = stack.pop()\nheap[b] = a',
+    Retrieve.opcode: 'stack.append(heap[stack.pop()])',
+    Call.opcode: 'call_stack.append({next})\nreturn {argument}',
+    Jump.opcode: 'return {argument}',
+    JumpIfZero.opcode: 'return {argument} if stack.pop() == 0 else {next}',
+    JumpIfNegative.opcode: 'return {argument} if stack.pop() < 0 else {next}',
+    Return.opcode: 'return call_stack.pop()',
+    Exit.opcode: 'vm.stop()\nreturn {ip}',
+    WriteChar.opcode: 'output.append(chr(stack.pop()))',
+    WriteNumber.opcode: 'output.append(str(stack.pop()))',
+}
+
+BRANCH_OPCODES = {Call.opcode, Jump.opcode, JumpIfZero.opcode, JumpIfNegative.opcode}
+
+BLOCK_TERMINATORS = BRANCH_OPCODES | {Return.opcode, Exit.opcode}
+
+# Number of times a block is interpreted before it gets compiled. Compiling costs
+# about as much as interpreting the same block 25 to 30 times.
+COMPILE_THRESHOLD = 32
+
+# Longer straight-line runs are split into several blocks, since compile time
+# grows faster than linearly with the size of the generated function
+MAX_BLOCK_LENGTH = 256
+
+def block_source(instructions, start, ends):
+    # Generates a function that receives the machine state and returns a closure executing
+    # the block starting at start, which returns the index of the next instruction.
+    # Number literals are passed in as constants rather than written into the source,
+    # since arbitrarily large integers cannot always be converted to decimal text.
+    constants = []
+    lines = []
+    ip = start
+    while True:
+        opcode, argument = instructions[ip]
+        if opcode in BLOCK_TEMPLATES:
+            template = BLOCK_TEMPLATES[opcode]
         else:
-            vm.instruction_index += 1
-
-class JumpIfNegative(Unary):
-    def perform(self, vm):
-        if vm.stack.pop() < 0:
-            vm.instruction_index = vm.label_table[self.argument]
+            template = f'{HANDLERS[opcode].__name__}(vm, {{ip}}, {{argument}})'
+        if opcode not in BRANCH_OPCODES and argument is not None:
+            constants.append(argument)
+            argument = f'constant_{len(constants) - 1}'
+        for line in template.format(ip=ip, next=ip + 1, argument=argument).split('\n'):
+            lines.append(f'        {line}')
+        ip += 1
+        if opcode in BLOCK_TERMINATORS:
+            break
+        if ip == len(instructions) or ip in ends or ip - start == MAX_BLOCK_LENGTH:
+            lines.append(f'        return {ip}')
+            break
+    header = ['def make_block(vm, stack, heap, call_stack, output, constants):']
+    if constants:
+        header.append('    ' + ''.join(f'constant_{index}, ' for index in range(len(constants))) + '= constants')
+    header.append('    def block():')
+    lines.append('    return block')
+    return ('\n'.join(header + lines), tuple(constants))
+
+def compile_block(source):
+    namespace = {}
+    exec(compile(source, '<whitespace>', 'exec'), globals(), namespace)
+    return namespace['make_block']
+
+@functools.lru_cache(maxsize=16)
+def compiled_blocks(program):
+    # Per program, maps block starts to (make_block, constants), shared by every machine
+    # running that program so that hot blocks are compiled only once
+    return {}
+
+class BlockCache(dict):
+    # Maps an instruction index to a function that executes the straight-line block starting there
+    # and returns the index of the next instruction. A block is interpreted with HANDLERS at first
+    # and only compiled once it has run COMPILE_THRESHOLD times, so code that runs once or
+    # a few times does not pay for code generation.
+    def __init__(self, vm):
+        self.vm = vm
+        self.state = (vm, vm.stack, vm.heap, vm.call_stack, vm.output_parts)
+        self.targets = {argument for opcode, argument in vm.instructions if opcode in BRANCH_OPCODES}
+        self.compiled = compiled_blocks(tuple(vm.instructions))
+
+    def __missing__(self, ip):
+        if ip in self.compiled:
+            block = self[ip] = self.compiled_block(ip)
         else:
-            vm.instruction_index += 1
+            block = self[ip] = self.interpreted_block(ip)
+        return block
+
+    def interpreted_block(self, start):
+        vm = self.vm
+        instructions = vm.instructions
+        targets = self.targets
+        runs = 0
+
+        def block():
+            nonlocal runs
+            runs += 1
+            if runs == COMPILE_THRESHOLD:
+                self[start] = self.compiled_block(start)
+            ip = start
+            while True:
+                opcode, argument = instructions[ip]
+                next_ip = HANDLERS[opcode](vm, ip, argument)
+                if opcode in BLOCK_TERMINATORS:
+                    return next_ip
+                ip = next_ip
+                if ip == len(instructions) or ip in targets or ip - start == MAX_BLOCK_LENGTH:
+                    return ip
+
+        return block
+
+    def compiled_block(self, start):
+        if start not in self.compiled:
+            source, constants = block_source(self.vm.instructions, start, self.targets)
+            self.compiled[start] = (compile_block(source), constants)
+        make_block, constants = self.compiled[start]
+        return make_block(*self.state, constants)
+
+def build_trie(tokens):
+    trie = {}
+    for prefix, leaf in tokens:
+        node = trie
+        for char in prefix[:-1]:
+            node = node.setdefault(char, {})
+        node[prefix[-1]] = leaf
+    return trie
+
+# Maps each instruction prefix to (instruction, kind of argument that follows it).
+# Instructions without argument are shared instances, the others are classes instantiated per token.
+TRIE = build_trie([
+    ('  ', (Push, 'number')),
+    (' \n ', (Duplicate(), None)),
+    (' \t ', (Copy, 'number')),
+    (' \n\t', (Swap(), None)),
+    (' \n\n', (Discard(), None)),
+    (' \t\n', (Slide, 'number')),
+    ('\t   ', (Add(), None)),
+    ('\t  \t', (Subtract(), None)),
+    ('\t  \n', (Multiply(), None)),
+    ('\t \t ', (Division(), None)),
+    ('\t \t\t', (Modulo(), None)),
+    ('\t\t ', (Store(), None)),
+    ('\t\t\t', (Retrieve(), None)),
+    ('\n  ', (Label, 'label')),
+    ('\n \t', (Call, 'label')),
+    ('\n \n', (Jump, 'label')),
+    ('\n\t ', (JumpIfZero, 'label')),
+    ('\n\t\t', (JumpIfNegative, 'label')),
+    ('\n\t\n', (Return(), None)),
+    ('\n\n\n', (Exit(), None)),
+    ('\t\n  ', (WriteChar(), None)),
+    ('\t\n \t', (WriteNumber(), None)),
+    ('\t\n\t ', (ReadChar(), None)),
+    ('\t\n\t\t', (ReadNumber(), None)),
+])
+
+BINARY_DIGITS = str.maketrans(' \t', '01')
 
 def tokenize(instructions):
-    def next():
-        nonlocal index
-        result = instructions[index]
-        index += 1
-        return result
-
-    def matches(prefix):
-        nonlocal index
-        if instructions[index:index+len(prefix)] == prefix:
-            index += len(prefix)
-            return True
-        else:
-            return False
-
     def number():
-        sign = 1 if next() == ' ' else -1
-        value = 0
-        while (current := next()) != '\n':
-            value = value * 2 + (0 if current == ' ' else 1)
-        return sign * value
+        nonlocal index
+        sign = 1 if instructions[index] == ' ' else -1
+        end = instructions.index('\n', index + 1)
+        bits = instructions[index + 1:end].translate(BINARY_DIGITS)
+        index = end + 1
+        return sign * int(bits, 2) if bits else 0
 
     def label():
-        result = ''
-        while (current := next()) != '\n':
-            result += current
+        nonlocal index
+        end = instructions.index('\n', index)
+        result = instructions[index:end]
+        index = end + 1
         return result
 
     index = 0
 
     while index < len(instructions):
-        if matches('  '): yield Push(number())
-        elif matches(' \n '): yield Duplicate()
-        elif matches(' \t '): yield Copy(number())
-        elif matches(' \n\t'): yield Swap()
-        elif matches(' \n\n'): yield Discard()
-        elif matches(' \t\n'): yield Slide(number())
-        elif matches('\t   '): yield Add()
-        elif matches('\t  \t'): yield Subtract()
-        elif matches('\t  \n'): yield Multiply()
-        elif matches('\t \t '): yield Division()
-        elif matches('\t \t\t'): yield Modulo()
-        elif matches('\t\t '): yield Store()
-        elif matches('\t\t\t'): yield Retrieve()
-        elif matches('\n  '): yield Label(label())
-        elif matches('\n \t'): yield Call(label())
-        elif matches('\n \n'): yield Jump(label())
-        elif matches('\n\t '): yield JumpIfZero(label())
-        elif matches('\n\t\t'): yield JumpIfNegative(label())
-        elif matches('\n\t\n'): yield Return()
-        elif matches('\n\n\n'): yield Exit()
-        elif matches('\t\n  '): yield WriteChar()
-        elif matches('\t\n \t'): yield WriteNumber()
-        elif matches('\t\n\t '): yield ReadChar()
-        elif matches('\t\n\t\t'): yield ReadNumber()
-        else: raise RuntimeError(f'Unrecognized token: {repr(instructions[index:])}')
+        start = index
+        node = TRIE
+        try:
+            while type(node) is dict:
+                node = node[instructions[index]]
+                index += 1
+        except (KeyError, IndexError):
+            raise RuntimeError(f'Unrecognized token: {repr(instructions[start:])}')
+        instruction, argument = node
+        if argument is None: yield instruction
+        elif argument == 'number': yield instruction(number())
+        else: yield instruction(label())
 
 class VirtualMachine:
-    def __init__(self, instructions, label_table, input):
+    def __init__(self, instructions, input):
         self.instructions = instructions
-        self.label_table = label_table
-        self.input = input
+        self.input = input.decode('utf-8') if isinstance(input, bytes) else input
         self.input_index = 0
         self.instruction_index = 0
         self.call_stack = []
         self.stack = []
         self.heap = {}
-        self.output = ''
+        self.output_parts = []
         self.running = True
+        self.blocks = BlockCache(self)
 
     def step(self):
-        self.current_instruction.perform(self)
+        ip = self.instruction_index
+        opcode, argument = self.instructions[ip]
+        self.instruction_index = HANDLERS[opcode](self, ip, argument)
 
     def run(self):
-        steps = 100
-        while self.running and steps > 0:
-            self.step()
-            steps -= 1
+        blocks = self.blocks
+        ip = self.instruction_index
+        try:
+            while self.running:
+                ip = blocks[ip]()
+        finally:
+            self.instruction_index = ip
 
     def stop(self):
         self.running = False
@@ -243,22 +507,44 @@ class VirtualMachine:
     def current_instruction(self):
         return self.instructions[self.instruction_index]
 
+    @property
+    def output(self):
+        return ''.join(self.output_parts)
+
 def parse(tokens):
+    def label_id(label):
+        if label not in label_ids:
+            label_ids[label] = len(table)
+            table.append(None)
+        return label_ids[label]
+
     instructions = []
-    table = {}
+    branches = []
+    label_ids = {}
+    table = []
     for token in tokens:
-        if isinstance(token, Label):
-            if token.argument in table:
+        if token.is_label:
+            label_index = label_id(token.argument)
+            if table[label_index] is not None:
                 raise RuntimeError()
-            table[token.argument] = len(instructions)
+            table[label_index] = len(instructions)
+        elif token.is_branch:
+            branches.append(len(instructions))
+            instructions.append((token.opcode, label_id(token.argument)))
         else:
-            instructions.append(token)
-    return (instructions, table)
+            instructions.append(token.lowered)
+    for label, label_index in label_ids.items():
+        if table[label_index] is None:
+            raise RuntimeError(f'Undefined label: {repr(label)}')
+    for index in branches:
+        opcode, label_index = instructions[index]
+        instructions[index] = (opcode, table[label_index])
+    return instructions
 
 def whitespace(code, input=''):
     tokens = tokenize(sanitize(code))
-    instructions, label_table = parse(tokens)
-    vm = VirtualMachine(instructions, label_table, input)
+    instructions = parse(tokens)
+    vm = VirtualMachine(instructions, input)
     vm.run()
     return vm.output
 